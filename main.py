@@ -1,13 +1,21 @@
 from dotenv import load_dotenv
 import os
 import json
+import orjson
 from flask import Flask, render_template, request, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
 
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """请求体解析使用 orjson，响应序列化沿用 Flask 默认实现"""
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder='static')
+app.json = OrjsonProvider(app)
 
 if os.getenv('DEBUG', 'False').lower() == 'true':
     app.config['DEBUG'] = True
@@ -1,11 +1,29 @@
-import json
+import orjson
+from functools import wraps
 from utils.models.deepseek import chat
 from flask import Blueprint, request, jsonify, Response, stream_with_context, g
 
 chat_page = Blueprint('chat', __name__)
 
+def require_chat_payload(view):
+    """解析并校验聊天请求体，将 prompt / thinking 传给视图函数"""
+    @wraps(view)
+    def wrapper():
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            data = {}
+        prompt = str(data.get('prompt') or '').strip()
+        thinking = data.get('thinking', True)
+
+        if not prompt:
+            return {'error': '问题不能为空'}, 400
+
+        return view(prompt, thinking)
+    return wrapper
+
 @chat_page.route('/endpoint', methods=['POST'])
-def chat_endpoint():
+@require_chat_payload
+def chat_endpoint(prompt, thinking):
     """
     聊天接口 - 流式返回 SSE 格式数据
     
@@ -14,22 +32,19 @@ def chat_endpoint():
             "prompt": "用户问题",
             "thinking": true/false (可选, 默认true)
         }
+    Query:
+        nobatch=1 (可选) 关闭 message 增量合并，每个增量单独一帧（调试用）
     """
-    data = request.get_json()
-    prompt = data.get('prompt', '').strip()
-    thinking = data.get('thinking', True)
-    
-    if not prompt:
-        return {'error': '问题不能为空'}, 400
+    coalesce = request.args.get('nobatch') != '1'
     
     def generate():
         """生成SSE流"""
         try:
-            for chunk in chat(prompt, stream=True, thinking=thinking):
+            for chunk in chat(prompt, stream=True, thinking=thinking, coalesce=coalesce):
                 yield chunk
         except Exception as e:
-            error_msg = f"event: error\ndata: {json.dumps({'error': str(e), 'message': '处理请求时发生错误'}, ensure_ascii=False)}\n\n"
-            yield error_msg
+            error_msg = orjson.dumps({'error': str(e), 'message': '处理请求时发生错误'})
+            yield b"event: error\ndata: " + error_msg + b"\n\n"
     
     return Response(generate(), mimetype='text/event-stream', 
                     headers={
@@ -39,7 +54,8 @@ def chat_endpoint():
 
 
 @chat_page.route('/endpoint-sync', methods=['POST'])
-def chat_sync_endpoint():
+@require_chat_payload
+def chat_sync_endpoint(prompt, thinking):
     """
     同步聊天接口 - 直接返回最终结果（不使用SSE）
     
@@ -49,13 +65,6 @@ def chat_sync_endpoint():
             "thinking": true/false (可选, 默认true)
         }
     """
-    data = request.get_json()
-    prompt = data.get('prompt', '').strip()
-    thinking = data.get('thinking', True)
-    
-    if not prompt:
-        return {'error': '问题不能为空'}, 400
-    
     try:
         result = chat(prompt, stream=False, thinking=thinking)
         return {'success': True, 'result': result}
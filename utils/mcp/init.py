@@ -1,10 +1,45 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import uuid
 import os
-from dotenv import load_dotenv; load_dotenv()
+import orjson
+import time
+import hashlib
+if 'STOCK_MCP_API_KEY' not in os.environ:
+    from dotenv import load_dotenv; load_dotenv()
 
 MCP_URL = "https://data-api.investoday.net/data/mcp/preset"
 API_KEY = os.environ.get('STOCK_MCP_API_KEY')
+TOOL_LIST_TTL = 300  # 工具列表缓存时间（秒）
+
+_TOOL_CACHE = {"ts": 0.0, "val": None, "digest": None}
+
+# 返回盘中实时变化数据的工具（行情、日行情指标、市场涨跌分布、随股价变动的估值/评分、新闻），
+# 调用过这些工具的回答不做缓存
+LIVE_DATA_TOOLS = frozenset({
+    "get_stock_quote_realtime",
+    "get_stock_realtime_quote_merge",
+    "get_fund_quote_realtime",
+    "get_market_change_ratio_status",
+    "list_stock_unadjusted_quotes",
+    "list_stock_adjusted_quotes",
+    "list_stock_performance_metrics",
+    "get_stock_finance_valuation",
+    "get_stock_score",
+    "list_news",
+    "list_entity_related_news",
+})
+
+# 复用同一个 Session（连接池 + keep-alive），避免每次调用都重新握手
+# MCP 接口均为查询类请求，允许对 POST 重试连接错误和网关错误；
+# 读超时/读错误不重试（read=0），否则单次卡住的调用会被放大为多个 timeout
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, read=0, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["POST"]),
+))
 
 def call(method: str, params: dict):
     payload = {
@@ -18,33 +53,62 @@ def call(method: str, params: dict):
         "Content-Type": "application/json"
     }
 
-    response = requests.post(
+    response = _SESSION.post(
         f"{MCP_URL}?apiKey={API_KEY}",
-        json=payload,
+        data=orjson.dumps(payload),
         headers=headers,
         timeout=60
     )
 
     response.raise_for_status()
+    # 响应用标准库解析：orjson 不接受 NaN/Infinity，且会把超过 64 位的整数静默转成 float
+    # （这类整数回填/输出时由 deepseek._dump_result 退回标准库序列化，数值保持不变）
     data = response.json()
     if isinstance(data, dict) and data.get("error"):
         raise RuntimeError(f"MCP error: {data['error']}")
     return data
 
+def _canonical(obj):
+    """递归按 key 排序，保证序列化结果与服务端返回顺序无关"""
+    if isinstance(obj, dict):
+        return {k: _canonical(obj[k]) for k in sorted(obj)}
+    if isinstance(obj, list):
+        return [_canonical(v) for v in obj]
+    return obj
+
 def mcp_to_openai_tool(mcp_tool):
     return {
         "type": "function",
         "function": {
             "name": mcp_tool["name"],
             "description": mcp_tool.get("description"),
-            "parameters": mcp_tool.get("inputSchema")
+            "parameters": _canonical(mcp_tool.get("inputSchema"))
         },
     }
 
 def tool_list():
+    """
+    获取工具列表（OpenAI 格式），结果缓存 TOOL_LIST_TTL 秒
+
+    工具按名称排序、schema 按 key 排序，使每次请求的 tools 前缀逐字节一致，
+    便于命中 DeepSeek 的上下文（前缀）缓存
+    """
+    if _TOOL_CACHE["val"] is not None and time.monotonic() - _TOOL_CACHE["ts"] < TOOL_LIST_TTL:
+        return _TOOL_CACHE["val"]
     data = call("tools/list", {})
-    mcp_tools = data.get("result", []).get("tools", [])
-    return [mcp_to_openai_tool(t) for t in mcp_tools]
+    mcp_tools = data.get("result", {}).get("tools", [])
+    tools = [mcp_to_openai_tool(t) for t in sorted(mcp_tools, key=lambda t: t["name"])]
+    _TOOL_CACHE["val"] = tools
+    _TOOL_CACHE["digest"] = hashlib.blake2b(
+        orjson.dumps(tools), digest_size=16
+    ).hexdigest()
+    _TOOL_CACHE["ts"] = time.monotonic()
+    return tools
+
+def tool_list_digest():
+    """当前工具列表的摘要，工具定义变化时随之变化（用于回答缓存的 key）"""
+    tool_list()
+    return _TOOL_CACHE["digest"]
 
 def tool_call(name, arguments):
     return call(
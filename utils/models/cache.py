@@ -0,0 +1,60 @@
+import os, time, hashlib, sqlite3, threading
+
+DB_PATH = "./cache/responses.db"
+DISK_CACHE_TTL = 3600  # 磁盘缓存有效期（秒）
+REALTIME_CACHE_TTL = 300  # 问题涉及实时/最新数据时的有效期（秒）
+REALTIME_KEYWORDS = ("实时", "最新", "当前", "目前", "现在", "今天", "今日", "盘中", "行情", "股价", "价格", "涨跌")
+
+_local = threading.local()  # sqlite 连接不能跨线程共享，每个线程一个
+
+
+def _conn():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")  # 允许多个读者与写者并发
+        conn.execute("CREATE TABLE IF NOT EXISTS resp (k BLOB PRIMARY KEY, ts INTEGER, content TEXT)")
+        _local.conn = conn
+    return conn
+
+
+def make_key(*parts):
+    """由 (prompt, thinking, model, 工具摘要...) 生成缓存 key"""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b"\0")
+    return h.digest()
+
+
+def ttl_for(prompt):
+    """按问题内容选择有效期：涉及实时行情的问题只缓存 REALTIME_CACHE_TTL 秒"""
+    if any(k in prompt for k in REALTIME_KEYWORDS):
+        return REALTIME_CACHE_TTL
+    return DISK_CACHE_TTL
+
+
+def load(key, ttl=DISK_CACHE_TTL):
+    """读取未过期的回答，未命中或出错时返回 None"""
+    try:
+        row = _conn().execute(
+            "SELECT content FROM resp WHERE k = ? AND ts > ?",
+            (key, int(time.time()) - ttl)
+        ).fetchone()
+    except (sqlite3.Error, OSError):  # 目录不可写、路径不存在等同样视为未命中
+        return None
+    return row[0] if row else None
+
+
+def store(key, content):
+    """写入回答；缓存写失败不影响正常返回"""
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO resp (k, ts, content) VALUES (?, ?, ?)",
+                (key, int(time.time()), content)
+            )
+    except (sqlite3.Error, OSError):
+        pass
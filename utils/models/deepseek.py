@@ -1,23 +1,129 @@
-import os, json, time
-from dotenv import load_dotenv; load_dotenv()
+import os, io, json, time, threading
+from functools import lru_cache
+import orjson
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+if 'DEEPSEEK_API_KEY' not in os.environ:
+    from dotenv import load_dotenv; load_dotenv()
 from openai import OpenAI
 import utils.mcp.init as mcp
+import utils.models.cache as response_cache
+
+MODEL = "deepseek-chat"
 
 client = OpenAI(
     api_key=os.environ.get('DEEPSEEK_API_KEY'),
     base_url="https://api.deepseek.com")
 
-def _chat_stream(prompt, mcp_max_call=20, thinking=True):
-    """流式输出（生成器）- 返回 SSE 格式"""
+# 系统提示词在模块加载时构建一次，保证每次请求的前缀完全一致（命中服务端前缀缓存）
+# 工具列表由 mcp.tool_list() 按 TTL 缓存，不在导入时请求网络
+SYSTEM_PROMPT = (
+    "你是专业的A股分析助手。\n"
+    "当用户询问具体股票的实时价格/涨跌幅/成交量等最新行情时，必须优先调用相关工具获取最新数据后再分析，你最多只能调用1个工具"
+    "禁止凭空猜测实时行情。"
+)
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+_STREAM_SYSTEM_MSG = {
+    "role": "system",
+    "content": SYSTEM_PROMPT + "\nThis model's maximum context length is 131072 tokens. ",
+}
+
+# 非流式结果内存缓存：(prompt, thinking) -> (写入时间, 回答)；其后还有一层磁盘缓存（utils/models/cache.py）
+RESPONSE_CACHE_TTL = 60  # 秒
+RESPONSE_CACHE_SIZE = 512
+_RESPONSE_CACHE = OrderedDict()
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+
+def _cache_get(key):
+    with _RESPONSE_CACHE_LOCK:
+        hit = _RESPONSE_CACHE.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] >= RESPONSE_CACHE_TTL:
+            del _RESPONSE_CACHE[key]
+            return None
+        _RESPONSE_CACHE.move_to_end(key)
+        return hit[1]
+
+
+def _cache_set(key, value):
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = (time.monotonic(), value)
+        _RESPONSE_CACHE.move_to_end(key)
+        while len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+            _RESPONSE_CACHE.popitem(last=False)
+
+
+# SSE 事件头预先编码为 bytes，每帧只需拼接
+_EV_START = b"event: start\ndata: "
+_EV_REASONING = b"event: reasoning\ndata: "
+_EV_MESSAGE = b"event: message\ndata: "
+_EV_TOOL_CALL = b"event: tool_call\ndata: "
+_EV_TOOL_RESULT = b"event: tool_result\ndata: "
+_EV_ERROR = b"event: error\ndata: "
+_EV_END = b"event: end\ndata: "
+_FRAME_END = b"\n\n"
+
+
+def _sse(event, data):
+    """构造一帧 SSE 数据（bytes），event 为上面的 _EV_* 常量"""
+    return event + orjson.dumps(data) + _FRAME_END
+
+
+def _dump_result(obj):
+    """序列化工具结果（bytes）；orjson 不支持超过 64 位的整数，此时退回标准库 json"""
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        return json.dumps(obj, ensure_ascii=False).encode()
+
+
+@lru_cache(maxsize=256)
+def _parse_args(arguments):
+    """解析工具调用参数；多轮中常以相同参数重复调用同一工具，按原始字符串缓存（返回值只读）"""
+    return orjson.loads(arguments or "{}")
+
+
+COALESCE_MS = 15  # message 增量合并窗口（毫秒）
+MAX_TOOL_WORKERS = 8  # 同一轮并发执行的工具调用上限（低于 MCP 连接池的 pool_maxsize）
+
+
+class _Coalescer:
+    """合并短时间内连续到达的 message 增量，减少 SSE 帧数"""
+
+    def __init__(self, window_ms, max_chars=4096):
+        self.window_ns = window_ms * 1_000_000
+        self.max_chars = max_chars
+        self.parts = []
+        self.size = 0
+        self.last_flush_ns = 0
+
+    def add(self, text):
+        """加入一段增量；距上次输出超过窗口或累计过长时返回合并后的帧，否则返回 None"""
+        self.parts.append(text)
+        self.size += len(text)
+        now = time.monotonic_ns()
+        if now - self.last_flush_ns >= self.window_ns or self.size >= self.max_chars:
+            self.last_flush_ns = now
+            return self.flush()
+        return None
+
+    def flush(self):
+        """输出缓冲中的全部内容（无内容时返回 None）"""
+        if not self.parts:
+            return None
+        frame = _sse(_EV_MESSAGE, {'content': ''.join(self.parts)})
+        self.parts = []
+        self.size = 0
+        return frame
+
+
+def _chat_stream(prompt, mcp_max_call=20, thinking=True, coalesce=True):
+    """流式输出（生成器）- 返回 SSE 格式（bytes）"""
     tools = mcp.tool_list()
-    system_prompt = (
-        "你是专业的A股分析助手。\n"
-        "当用户询问具体股票的实时价格/涨跌幅/成交量等最新行情时，必须优先调用相关工具获取最新数据后再分析，你最多只能调用1个工具"
-        "禁止凭空猜测实时行情。\n"
-        "This model's maximum context length is 131072 tokens. "
-    )
     messages = [
-        {"role": "system", "content": system_prompt},
+        _STREAM_SYSTEM_MSG,
         {"role": "user", "content": prompt},
     ]
     
@@ -28,12 +134,17 @@ def _chat_stream(prompt, mcp_max_call=20, thinking=True):
         'tokens': {'prompt': 0, 'completion': 0, 'total': 0},
         'timing_ms': {'first_byte': 0, 'total': 0}
     }
-    start_time = time.time() * 1000  # 转换为毫秒
-    first_byte_time = None
+    start_ns = time.monotonic_ns()  # 单调时钟，不受系统时间调整影响
+    first_byte_ns = None
+    
+    content_buf = io.StringIO()
+    reasoning_buf = io.StringIO()  # 用于存储推理内容（如果有）
+    # 其他事件输出前先冲刷已缓冲的 message，保证事件顺序不变
+    coalescer = _Coalescer(COALESCE_MS if coalesce else 0)
     
     for call_round in range(mcp_max_call):
         resp = client.chat.completions.create(
-            model="deepseek-chat",
+            model=MODEL,
             messages=messages,
             tools=tools,
             tool_choice="auto",
@@ -44,88 +155,99 @@ def _chat_stream(prompt, mcp_max_call=20, thinking=True):
         # 第一轮时发送 start 事件
         if call_round == 0:
             start_data = {
-                'model': 'deepseek-chat',
+                'model': MODEL,
                 'reasoning': 'enabled' if thinking else 'disabled'
             }
-            yield f"event: start\ndata: {json.dumps(start_data, ensure_ascii=False)}\n\n"
+            yield _sse(_EV_START, start_data)
         
-        # 流式输出处理
-        content_chunks = []
-        reasoning_chunks = []  # 用于存储推理内容（如果有）
-        tool_calls_dict = {}  # {index: {id, name, arguments}}
+        # 流式输出处理（缓冲区跨轮复用，每轮开始时清空）
+        content_buf.seek(0); content_buf.truncate()
+        reasoning_buf.seek(0); reasoning_buf.truncate()
+        tool_calls_list = []  # 按 index 排列，arguments 在流结束前为 StringIO
         last_chunk = None  # 保存最后一个 chunk 以获取 token 信息
+        finish_reason = None  # 模型给出的结束原因（stop / length / tool_calls）
         
         for chunk in resp:
             # 记录首字节时间
-            if first_byte_time is None:
-                first_byte_time = time.time() * 1000
-                stats['timing_ms']['first_byte'] = int(first_byte_time - start_time)
+            if first_byte_ns is None:
+                first_byte_ns = time.monotonic_ns()
+                stats['timing_ms']['first_byte'] = (first_byte_ns - start_ns) // 1_000_000
             
             last_chunk = chunk
-            delta = chunk.choices[0].delta
+            choice = chunk.choices[0]
+            delta = choice.delta
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
             
             # 处理推理内容（reasoning_content，如果模型支持）
-            if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
-                reasoning_chunks.append(delta.reasoning_content)
-                yield f"event: reasoning\ndata: {json.dumps({'content': delta.reasoning_content}, ensure_ascii=False)}\n\n"
+            reasoning_content = getattr(delta, 'reasoning_content', None)
+            if reasoning_content:
+                reasoning_buf.write(reasoning_content)
+                frame = coalescer.flush()
+                if frame:
+                    yield frame
+                yield _sse(_EV_REASONING, {'content': reasoning_content})
             
             # 处理内容增量
-            if hasattr(delta, 'content') and delta.content:
-                content_chunks.append(delta.content)
-                # SSE 格式输出
-                yield f"event: message\ndata: {json.dumps({'content': delta.content}, ensure_ascii=False)}\n\n"
+            content = delta.content
+            if content:
+                content_buf.write(content)
+                # SSE 格式输出（可能与相邻增量合并为一帧）
+                frame = coalescer.add(content)
+                if frame:
+                    yield frame
             
             # 处理工具调用增量
-            if hasattr(delta, 'tool_calls') and delta.tool_calls:
-                for tc_delta in delta.tool_calls:
-                    idx = tc_delta.index
-                    if idx not in tool_calls_dict:
-                        tool_calls_dict[idx] = {
+            tool_call_deltas = delta.tool_calls
+            if tool_call_deltas:
+                for tc_delta in tool_call_deltas:
+                    # 增量按 index 递增到达，新 index 时追加占位
+                    while len(tool_calls_list) <= tc_delta.index:
+                        tool_calls_list.append({
                             'id': '',
-                            'name': '',
-                            'arguments': ''
-                        }
+                            'type': 'function',
+                            'function': {'name': '', 'arguments': io.StringIO()}
+                        })
+                    tc = tool_calls_list[tc_delta.index]
                     
                     if tc_delta.id:
-                        tool_calls_dict[idx]['id'] = tc_delta.id
-                    if hasattr(tc_delta.function, 'name') and tc_delta.function.name:
-                        tool_calls_dict[idx]['name'] = tc_delta.function.name
-                    if hasattr(tc_delta.function, 'arguments') and tc_delta.function.arguments:
-                        tool_calls_dict[idx]['arguments'] += tc_delta.function.arguments
+                        tc['id'] = tc_delta.id
+                    function = tc_delta.function
+                    name = getattr(function, 'name', None)
+                    if name:
+                        tc['function']['name'] = name
+                    arguments = getattr(function, 'arguments', None)
+                    if arguments:
+                        tc['function']['arguments'].write(arguments)
+        
+        # 流结束，输出剩余的 message 内容
+        frame = coalescer.flush()
+        if frame:
+            yield frame
         
-        # 流结束，提取 token 信息
-        if last_chunk and hasattr(last_chunk, 'usage') and last_chunk.usage:
-            usage = last_chunk.usage
+        # 提取 token 信息
+        usage = getattr(last_chunk, 'usage', None)
+        if usage:
             stats['tokens']['prompt'] = getattr(usage, 'prompt_tokens', 0)
             stats['tokens']['completion'] = getattr(usage, 'completion_tokens', 0)
             stats['tokens']['total'] = getattr(usage, 'total_tokens', 0)
         
         # 计算总时间
-        stats['timing_ms']['total'] = int(time.time() * 1000 - start_time)
+        stats['timing_ms']['total'] = (time.monotonic_ns() - start_ns) // 1_000_000
         
-        # 判断是否有工具调用
-        if not tool_calls_dict:
-            # 没有工具调用，直接返回
+        # 快速路径：模型已结束且没有工具调用，直接发送 end，跳过消息重建
+        if not tool_calls_list:
             end_data = {
-                'finish_reason': 'stop',
+                'finish_reason': finish_reason or 'stop',
                 'stats': stats
             }
-            yield f"event: end\ndata: {json.dumps(end_data, ensure_ascii=False)}\n\n"
+            yield _sse(_EV_END, end_data)
             return
         
         # 有工具调用，构建消息并执行工具
-        full_content = ''.join(content_chunks)
-        tool_calls_list = []
-        for idx in sorted(tool_calls_dict.keys()):
-            tc = tool_calls_dict[idx]
-            tool_calls_list.append({
-                'id': tc['id'],
-                'type': 'function',
-                'function': {
-                    'name': tc['name'],
-                    'arguments': tc['arguments']
-                }
-            })
+        full_content = content_buf.getvalue()
+        for tc in tool_calls_list:
+            tc['function']['arguments'] = tc['function']['arguments'].getvalue()
         
         # 添加 assistant 消息（带工具调用）
         assistant_msg = {
@@ -135,103 +257,118 @@ def _chat_stream(prompt, mcp_max_call=20, thinking=True):
         }
         # 如果启用了推理模式，必须添加 reasoning_content（即使为空）
         if thinking:
-            assistant_msg['reasoning_content'] = ''.join(reasoning_chunks) if reasoning_chunks else ''
+            assistant_msg['reasoning_content'] = reasoning_buf.getvalue()
         
         messages.append(assistant_msg)
         
-        # 执行工具并回填结果
-        for i, tc in enumerate(tool_calls_list, 1):
-            tool_call_id = tc['id']
-            tool_name = tc['function']['name']
-            tool_args = json.loads(tc['function']['arguments'] or "{}")
-            
-            # 统计工具调用
-            stats['tool_calls'] += 1
-            
-            # 输出工具调用信息
-            tool_call_info = {
-                'id': tool_call_id,
-                'type': 'mcp',
-                'name': tool_name,
-                'arguments': tool_args,
-                'index': i,
-                'total': len(tool_calls_list)
-            }
-            yield f"event: tool_call\ndata: {json.dumps(tool_call_info, ensure_ascii=False)}\n\n"
-            
-            # 执行工具
-            try:
-                mcp_result = mcp.tool_call(tool_name, tool_args)
+        # 执行工具并回填结果：同一轮的工具调用互不依赖，提交到线程池并发执行，
+        # tool_result 按完成顺序输出，回填给模型的消息仍按 tool_calls_list 顺序
+        tool_contents = {}
+        # 不用 with：客户端断开（GeneratorExit）时不等待在途的工具调用，直接退出
+        executor = ThreadPoolExecutor(max_workers=min(len(tool_calls_list), MAX_TOOL_WORKERS))
+        try:
+            futures = {}
+            for i, tc in enumerate(tool_calls_list, 1):
+                tool_call_id = tc['id']
+                tool_name = tc['function']['name']
+                tool_args = _parse_args(tc['function']['arguments'])
                 
-                # 统计工具结果
-                stats['tool_results'] += 1
+                # 统计工具调用
+                stats['tool_calls'] += 1
                 
-                # 输出工具执行结果
-                tool_result_info = {
-                    'tool_call_id': tool_call_id,
+                # 输出工具调用信息
+                tool_call_info = {
+                    'id': tool_call_id,
+                    'type': 'mcp',
                     'name': tool_name,
-                    'success': True,
-                    'result': mcp_result
+                    'arguments': tool_args,
+                    'index': i,
+                    'total': len(tool_calls_list)
                 }
-                yield f"event: tool_result\ndata: {json.dumps(tool_result_info, ensure_ascii=False)}\n\n"
+                yield _sse(_EV_TOOL_CALL, tool_call_info)
+                
+                # 提交执行
+                futures[executor.submit(mcp.tool_call, tool_name, tool_args)] = i - 1
+            
+            for future in as_completed(futures):
+                idx = futures[future]
+                tool_call_id = tool_calls_list[idx]['id']
+                tool_name = tool_calls_list[idx]['function']['name']
                 
-                messages.append({
-                    'role': 'tool',
-                    'tool_call_id': tc['id'],
-                    'content': json.dumps(mcp_result, ensure_ascii=False),
-                })
-            except Exception as e:
                 # 统计工具结果（即使失败也算）
                 stats['tool_results'] += 1
                 
-                # 输出工具执行错误
-                tool_error_info = {
+                try:
+                    mcp_result = future.result()
+                except Exception as e:
+                    # 输出工具执行错误
+                    tool_error_info = {
+                        'tool_call_id': tool_call_id,
+                        'name': tool_name,
+                        'success': False,
+                        'error': str(e)
+                    }
+                    yield _sse(_EV_TOOL_RESULT, tool_error_info)
+                    tool_contents[idx] = orjson.dumps({'error': str(e)}).decode()
+                    continue
+                
+                # 结果只序列化一次，SSE 帧与回填消息共用
+                result_json = _dump_result(mcp_result)
+                
+                # 输出工具执行结果
+                tool_result_info = {
                     'tool_call_id': tool_call_id,
                     'name': tool_name,
-                    'success': False,
-                    'error': str(e)
+                    'success': True,
+                    'result': orjson.Fragment(result_json)
                 }
-                yield f"event: tool_result\ndata: {json.dumps(tool_error_info, ensure_ascii=False)}\n\n"
-                messages.append({
-                    'role': 'tool',
-                    'tool_call_id': tc['id'],
-                    'content': json.dumps({'error': str(e)}, ensure_ascii=False),
-                })
+                yield _sse(_EV_TOOL_RESULT, tool_result_info)
+                tool_contents[idx] = result_json.decode()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        for idx, tc in enumerate(tool_calls_list):
+            messages.append({
+                'role': 'tool',
+                'tool_call_id': tc['id'],
+                'content': tool_contents[idx],
+            })
         
         # 继续下一轮（流式）
         continue
     
     # 到达最大轮数
-    stats['timing_ms']['total'] = int(time.time() * 1000 - start_time)
+    stats['timing_ms']['total'] = (time.monotonic_ns() - start_ns) // 1_000_000
     
     error_info = {
         'finish_reason': 'length',
         'message': '工具调用次数过多，已停止'
     }
-    yield f"event: error\ndata: {json.dumps(error_info, ensure_ascii=False)}\n\n"
+    yield _sse(_EV_ERROR, error_info)
     end_data = {
         'finish_reason': 'length',
         'stats': stats
     }
-    yield f"event: end\ndata: {json.dumps(end_data, ensure_ascii=False)}\n\n"
+    yield _sse(_EV_END, end_data)
 
 
 def _chat_non_stream(prompt, mcp_max_call=20, thinking=True):
-    """非流式输出 - 直接返回最终结果"""
+    """
+    非流式输出 - 直接返回最终结果
+
+    Returns:
+        (回答内容, 是否可缓存)；调用过 mcp.LIVE_DATA_TOOLS 中的工具或达到调用上限时不可缓存
+    """
+    cacheable = True
     tools = mcp.tool_list()
-    system_prompt = (
-        "你是专业的A股分析助手。\n"
-        "当用户询问具体股票的实时价格/涨跌幅/成交量等最新行情时，必须优先调用相关工具获取最新数据后再分析，你最多只能调用1个工具"
-        "禁止凭空猜测实时行情。"
-    )
     messages = [
-        {"role": "system", "content": system_prompt},
+        _SYSTEM_MSG,
         {"role": "user", "content": prompt},
     ]
     
     for call_round in range(mcp_max_call):
         resp = client.chat.completions.create(
-            model="deepseek-chat",
+            model=MODEL,
             messages=messages,
             tools=tools,
             tool_choice="auto",
@@ -243,43 +380,65 @@ def _chat_non_stream(prompt, mcp_max_call=20, thinking=True):
 
         # 1) 没有 tool_calls -> 直接结束
         if not getattr(msg, "tool_calls", None):
-            return msg.content
+            return msg.content, cacheable
 
-        # 2) 有 tool_calls -> 逐个执行并回填，继续下一轮
+        # 2) 有 tool_calls -> 执行并回填，继续下一轮
         messages.append(msg)  # 把 assistant 的 tool_calls 消息加入上下文
+        if any(tc.function.name in mcp.LIVE_DATA_TOOLS for tc in msg.tool_calls):
+            cacheable = False  # 实时数据不缓存，避免返回过期价格
+
+        def run_tool(tc):
+            tool_args = _parse_args(tc.function.arguments)
+            return mcp.tool_call(tc.function.name, tool_args)
 
-        for tc in msg.tool_calls:
-            tool_name = tc.function.name
-            tool_args = json.loads(tc.function.arguments or "{}")
-            # 调 MCP 工具
-            mcp_result = mcp.tool_call(tool_name, tool_args)
+        # 同一轮的工具调用互不依赖，并发执行（I/O 密集）
+        with ThreadPoolExecutor(max_workers=min(len(msg.tool_calls), MAX_TOOL_WORKERS)) as executor:
+            mcp_results = list(executor.map(run_tool, msg.tool_calls))
 
-            # 回填给模型（role=tool 必须带 tool_call_id）
+        for tc, mcp_result in zip(msg.tool_calls, mcp_results):
+            # 回填给模型（role=tool 必须带 tool_call_id，按原顺序）
             messages.append(
                 {
                     "role": "tool",
                     "tool_call_id": tc.id,
-                    "content": json.dumps(mcp_result, ensure_ascii=False),
+                    "content": _dump_result(mcp_result).decode(),
                 }
             )
 
-    return "（工具调用次数过多，已停止）"
+    return "（工具调用次数过多，已停止）", False
 
 
-def chat(prompt, stream=False, mcp_max_call=20, thinking=True):
+def chat(prompt, stream=False, mcp_max_call=20, thinking=True, use_cache=True, coalesce=True):
     """
     与 AI 助手对话
     
     Args:
         prompt: 用户输入的问题
-        stream: 是否使用流式输出（True 时返回 SSE 格式）
+        stream: 是否使用流式输出（True 时返回 SSE 格式的 bytes 生成器）
         mcp_max_call: 最大工具调用次数
         thinking: 是否启用推理模式
+        use_cache: 非流式时是否使用结果缓存（先查内存，再查磁盘，相同问题直接返回）
+        coalesce: 流式时是否将 COALESCE_MS 内连续到达的 message 增量合并为一帧
     """
     if stream:
-        return _chat_stream(prompt, mcp_max_call, thinking)
-    else:
-        return _chat_non_stream(prompt, mcp_max_call, thinking)
+        return _chat_stream(prompt, mcp_max_call, thinking, coalesce)
+
+    key = (prompt, bool(thinking))
+    if use_cache:
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+        disk_key = response_cache.make_key(prompt, bool(thinking), MODEL, mcp.tool_list_digest())
+        cached = response_cache.load(disk_key, response_cache.ttl_for(prompt))
+        if cached is not None:
+            _cache_set(key, cached)
+            return cached
+
+    result, cacheable = _chat_non_stream(prompt, mcp_max_call, thinking)
+    if use_cache and cacheable and result:
+        _cache_set(key, result)
+        response_cache.store(disk_key, result)
+    return result
 
 
 if __name__ == "__main__":
@@ -289,6 +448,6 @@ if __name__ == "__main__":
         print(result)
     else:
         for chunk in chat("分析一下 600519 当前实时行情，并给出短线观点", stream=True):
-            print(chunk, end='', flush=True)
+            print(chunk.decode(), end='', flush=True)
 
 # Run: python -m utils.models.deepseek
\ No newline at end of file
@@ -1,33 +1,108 @@
+import os
+import importlib.util
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 
 model_path = "./cache/models/deepseek-ai/DeepSeek-R1-Distill-Qwen-1.5B"  # 你 snapshot_download 打印出来的目录
 
-tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-model = AutoModelForCausalLM.from_pretrained(
-    model_path,
-    dtype=torch.float16,  # 替换过时参数 torch_dtype -> dtype
-    device_map="auto",
-    trust_remote_code=True
-).eval()
-
-# 确保 pad_token_id 已设置以避免 "Setting `pad_token_id` to `eos_token_id`" 的提示
-if getattr(model.config, "pad_token_id", None) is None:
-    model.config.pad_token_id = tokenizer.eos_token_id
-
-prompt = "你好"
-inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-
-with torch.no_grad():
-    out = model.generate(
-        **inputs,
-        max_new_tokens=512,
-        do_sample=True,
-        temperature=0.7,
-        top_p=0.9,
-        # 显式传入 pad_token_id
-        pad_token_id=model.config.pad_token_id
-    )
+# 推理后端：transformers（默认）或 vllm（需自行安装 vllm，仅支持 Linux + CUDA）
+BACKEND = os.environ.get('LOCAL_LLM_BACKEND', 'transformers')
+# 权重量化：空（默认不量化）/ 8bit / 4bit，需自行安装 bitsandbytes，仅支持 CUDA
+QUANT = os.environ.get('LOCAL_LLM_QUANT', '')
+
+_tokenizer = None
+_model = None
+_llm = None
+
+
+def _attn_implementation():
+    """CUDA 且安装了 flash-attn 时使用 FlashAttention-2，否则使用 PyTorch 自带的 SDPA"""
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def _dtype():
+    """支持 BF16 的 GPU 上用 BF16（与 FP16 同带宽但数值范围更大），否则保持 FP16"""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+def _quantization_config():
+    """按 QUANT 构建量化配置；解码受显存带宽限制，权重字节数越少生成越快"""
+    if QUANT == '4bit':
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=_dtype(),
+            bnb_4bit_use_double_quant=True
+        )
+    if QUANT == '8bit':
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return None
+
+
+def get_model():
+    """按需加载 tokenizer 和模型（首次调用时加载，之后复用）"""
+    global _tokenizer, _model
+    if _model is None:
+        if torch.cuda.is_available():
+            torch.backends.cuda.matmul.allow_tf32 = True  # Ampere 及以上 GPU 的非注意力矩阵乘使用 TF32
+        _tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        _model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            dtype=_dtype(),  # 替换过时参数 torch_dtype -> dtype
+            attn_implementation=_attn_implementation(),
+            quantization_config=_quantization_config(),
+            device_map="auto",
+            trust_remote_code=True
+        ).eval()
+
+        # 确保 pad_token_id 已设置以避免 "Setting `pad_token_id` to `eos_token_id`" 的提示
+        if getattr(_model.config, "pad_token_id", None) is None:
+            _model.config.pad_token_id = _tokenizer.eos_token_id
+    return _tokenizer, _model
+
+
+def get_vllm():
+    """按需创建 vLLM 引擎（PagedAttention + 连续批处理）"""
+    global _llm
+    if _llm is None:
+        from vllm import LLM
+        _llm = LLM(
+            model=model_path,
+            dtype="auto",
+            gpu_memory_utilization=0.85,
+            max_model_len=4096,
+            trust_remote_code=True
+        )
+    return _llm
+
+
+def generate(prompt, max_new_tokens=512):
+    """使用本地模型生成回答（返回内容包含 prompt，与 transformers 后端一致）"""
+    if BACKEND == 'vllm':
+        from vllm import SamplingParams
+        params = SamplingParams(temperature=0.7, top_p=0.9, max_tokens=max_new_tokens)
+        out = get_vllm().generate([prompt], params)
+        return prompt + out[0].outputs[0].text
+
+    tokenizer, model = get_model()
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+
+    with torch.no_grad():
+        out = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.7,
+            top_p=0.9,
+            # 显式传入 pad_token_id
+            pad_token_id=model.config.pad_token_id
+        )
+    return tokenizer.decode(out[0], skip_special_tokens=True)
+
 
 if __name__ == "__main__":
-    print(tokenizer.decode(out[0], skip_special_tokens=True))
+    print(generate("你好"))